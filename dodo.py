@@ -1,30 +1,94 @@
 from __future__ import annotations
 
+import asyncio
 import base64
+import functools
 import hashlib
+import mmap
 import os
 import re
-import subprocess
+import tempfile
 import typing as t
+import unicodedata
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from string import Template
 from urllib.parse import urlparse
+from xml.sax.saxutils import escape
 
+import ahocorasick
 import httpx
-#import readabilipy
+import lxml.html
+import orjson
 import yaml
 from ebooklib import epub
-from ebooklib.utils import parse_string
-from jinja2 import Environment, PackageLoader, select_autoescape
-from lxml import etree
-from pydantic import BaseModel, validator
+from jinja2 import Environment, FileSystemBytecodeCache, PackageLoader, select_autoescape
+from jinja2.bccache import Bucket
+from pydantic import BaseModel, PrivateAttr, validator
+from readability import Document
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 build_dir = Path("build")
+
+
+class LazyFileSystemBytecodeCache(FileSystemBytecodeCache):
+    """
+    Bytecode cache that only creates its directory once there's something to store in it.
+    """
+    def dump_bytecode(self, bucket: Bucket) -> None:
+        Path(self.directory).mkdir(parents=True, exist_ok=True)
+        super().dump_bytecode(bucket)
+
+
+# Keep the compiled templates around between runs instead of parsing them again every time
+jinja_cache_dir = build_dir / ".jinja-cache"
 jinja_env = Environment(
     loader=PackageLoader(__name__),
-    autoescape=select_autoescape()
+    autoescape=select_autoescape(),
+    bytecode_cache=LazyFileSystemBytecodeCache(directory=str(jinja_cache_dir)),
 )
 book_yaml = "book.yaml"
+chapter_cache_dir = build_dir / ".chapter-cache"
+# Part of the chapter cache key. Bump it whenever the way the template arguments are computed from an entry
+# changes (e.g. the title/tag/export failure detection), so that renderings made the old way aren't reused.
+chapter_cache_version = "1"
+chapter_template_source, _, _ = jinja_env.loader.get_source(jinja_env, "chapter.jinja")
+chapter_template_hash = hashlib.sha256(chapter_template_source.encode("utf8")).hexdigest()
+
+_TAG_SPLIT = re.compile(r"\s*,\s*")
+_WS = re.compile(r"\s+")
+
+
+class _BasenameTable(dict):
+    # Translation table for str.translate that drops everything but alphanumerics, "_" and "-".
+    # Filled in lazily as characters are seen, as there are far too many code points to list upfront.
+    def __missing__(self, key: int) -> t.Optional[int]:
+        character = chr(key)
+        value = key if character.isalnum() or character in ("_", "-") else None
+        self[key] = value
+        return value
+
+
+_BASENAME_TABLE = _BasenameTable()
+
+
+def cached_model_property(func):
+    # functools.cached_property stores the value in the instance __dict__, where pydantic picks it up
+    # as a field value (it'd end up in .dict() and equality checks), so keep it in a private dict instead
+    @property
+    @functools.wraps(func)
+    def wrapper(self):
+        cache = self._property_cache
+        if func.__name__ not in cache:
+            cache[func.__name__] = func(self)
+        return cache[func.__name__]
+    return wrapper
 
 
 class Entry(BaseModel):
@@ -33,17 +97,17 @@ class Entry(BaseModel):
     emoji_name: str
     tags: t.List[str]
     url: str
+    _property_cache: dict = PrivateAttr(default_factory=dict)
 
     @validator("tags", pre=True)
     def split_tags(cls, v):
         if isinstance(v, str):
-            return re.split(r"\s*,\s*", v)
+            return _TAG_SPLIT.split(v)
         return v
 
-    @property
+    @cached_model_property
     def basename(self) -> str:
-        safe_characters = ("_", "-")
-        return "".join(c for c in re.sub(r"\s+", "-", self.title.lower()) if c.isalnum() or c in safe_characters).rstrip()
+        return _WS.sub("-", self.title.lower()).translate(_BASENAME_TABLE).rstrip()
 
     @property
     def google_drive_file_id(self) -> str:
@@ -58,19 +122,19 @@ class Entry(BaseModel):
     def chapter_title(self) -> str:
         return f":{self.emoji_name}: {self.title}"
 
-    @property
+    @cached_model_property
     def metadata_target(self) -> Path:
-        return (build_dir / self.basename).with_suffix(".yaml")
+        return (build_dir / self.basename).with_suffix(".json")
 
-    @property
+    @cached_model_property
     def raw_html_target(self) -> Path:
         return (build_dir / self.basename).with_suffix(".raw.html")
 
-    @property
+    @cached_model_property
     def readable_html_target(self) -> Path:
         return (build_dir / self.basename).with_suffix(".readable.html")
 
-    @property
+    @cached_model_property
     def emoji_target(self) -> Path:
         emoji_url = urlparse(self.emoji_url)
         return (build_dir / self.emoji_name).with_suffix(Path(emoji_url.path).suffix)
@@ -79,28 +143,28 @@ class Entry(BaseModel):
 class Book(BaseModel):
     title: str
     entries: t.List[Entry]
+    _property_cache: dict = PrivateAttr(default_factory=dict)
 
     @classmethod
     def from_yaml(cls, filename: str) -> Book:
-        content = yaml.load(open(book_yaml), Loader=yaml.SafeLoader)
+        with open(filename, "rb") as f:
+            content = yaml.load(f, Loader=SafeLoader)
         entries = list(map(lambda x: Entry(**x), content["entries"]))
         return cls(title=content["title"], entries=entries)
 
-    @property
+    @cached_model_property
     def identifier(self) -> str:
-        m = hashlib.sha256()
-        m.update(self.title.encode("utf8"))
-        return m.hexdigest()
+        return hashlib.sha256(self.title.encode("utf8")).hexdigest()
 
-    @property
-    def cover_html_target(self) -> Path:
-        return build_dir / "cover.html"
+    @cached_model_property
+    def cover_svg_target(self) -> Path:
+        return build_dir / "cover.svg"
 
-    @property
+    @cached_model_property
     def cover_image_target(self) -> Path:
         return build_dir / "cover.png"
 
-    @property
+    @cached_model_property
     def epub_target(self) -> Path:
         return build_dir / "book.epub"
 
@@ -108,12 +172,19 @@ class Book(BaseModel):
 book = Book.from_yaml(book_yaml)
 
 
+def write_if_changed(path: Path, content: bytes):
+    # Leave the file alone when the content is the same, so that its mtime only moves on actual changes.
+    # is_stale compares against it to decide which downloads to skip.
+    if path.exists() and path.read_bytes() == content:
+        return
+    path.write_bytes(content)
+
+
 def task_entries():
     def write_entries(targets):
+        build_dir.mkdir(exist_ok=True)
         for entry in book.entries:
-            entry.metadata_target.parent.mkdir(exist_ok=True)
-            with open(entry.metadata_target, "w") as f:
-                f.write(yaml.dump(entry.dict))
+            write_if_changed(entry.metadata_target, orjson.dumps(entry.dict()))
 
     return {
         "file_dep": [book_yaml],
@@ -122,49 +193,101 @@ def task_entries():
     }
 
 
-def task_raw_html():
-    def make_download_html(entry: Entry):
-        def download_html(targets):
-            export_url = f"https://www.googleapis.com/drive/v3/files/{entry.google_drive_file_id}/export"
-            response = httpx.get(export_url, params=dict(mimeType="text/html", key=os.environ["GOOGLE_API_KEY"]))
-            with open(targets[0], "w") as f:
-                f.write(response.text)
-        return download_html
-
-
-    for entry in book.entries:
-        yield {
-            "name": entry.basename,
-            "file_dep": [entry.metadata_target],
-            "targets": [entry.raw_html_target],
-            "actions": [make_download_html(entry)],
-        }
-
+def is_stale(target: Path, dependency: Path) -> bool:
+    return not target.exists() or target.stat().st_mtime < dependency.stat().st_mtime
+
+
+# Drive also reports rate limiting as a 403 with one of these reasons in the error body
+rate_limit_reasons = {"rateLimitExceeded", "userRateLimitExceeded"}
+
+
+def is_rate_limited(response: httpx.Response) -> bool:
+    if response.status_code == 429:
+        return True
+    if response.status_code != 403:
+        return False
+    try:
+        errors = response.json()["error"]["errors"]
+        return any(error.get("reason") in rate_limit_reasons for error in errors)
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return False
+
+
+def is_retryable(exception: BaseException) -> bool:
+    # Rate limiting and 5xx are transient failures. Other error responses are written out as they are,
+    # e.g. the export error that make_epub looks for.
+    if isinstance(exception, httpx.HTTPStatusError):
+        return is_rate_limited(exception.response) or exception.response.is_server_error
+    return isinstance(exception, httpx.TransportError)
+
+
+def task_download():
+    @retry(stop=stop_after_attempt(4), wait=wait_exponential(), retry=retry_if_exception(is_retryable), reraise=True)
+    async def stream_to_file(client: httpx.AsyncClient, url: str, target: Path, **kwargs):
+        # Write the body as it arrives instead of buffering the whole response in memory. It goes to a
+        # temporary file first so that a failed transfer doesn't leave behind a target that looks up-to-date.
+        partial_target = target.with_suffix(target.suffix + ".part")
+        try:
+            async with client.stream("GET", url, **kwargs) as response:
+                if response.status_code == 403:
+                    # Error bodies are small, read it to tell rate limiting apart from other errors
+                    await response.aread()
+                if is_rate_limited(response) or response.is_server_error:
+                    response.raise_for_status()
+                with open(partial_target, "wb") as f:
+                    async for chunk in response.aiter_bytes(65536):
+                        f.write(chunk)
+            os.replace(partial_target, target)
+        finally:
+            partial_target.unlink(missing_ok=True)
+
+    async def download_html(client: httpx.AsyncClient, entry: Entry):
+        export_url = f"https://www.googleapis.com/drive/v3/files/{entry.google_drive_file_id}/export"
+        params = dict(mimeType="text/html", key=os.environ["GOOGLE_API_KEY"])
+        await stream_to_file(client, export_url, entry.raw_html_target, params=params)
+
+    async def download_emoji(client: httpx.AsyncClient, entry: Entry):
+        await stream_to_file(client, entry.emoji_url, entry.emoji_target)
+
+    async def fetch_all():
+        # Bound the number of in-flight requests so we don't hammer the servers
+        semaphore = asyncio.Semaphore(8)
+
+        async def bounded(download, client: httpx.AsyncClient, entry: Entry):
+            async with semaphore:
+                await download(client, entry)
+
+        # With HTTP/2 the requests to the same host are multiplexed over a single connection
+        limits = httpx.Limits(max_connections=16, max_keepalive_connections=8, keepalive_expiry=60)
+        async with httpx.AsyncClient(http2=True, limits=limits, timeout=30) as client:
+            # All the downloads share a single task, so skip the files that are already up-to-date
+            downloads = []
+            for entry in book.entries:
+                if is_stale(entry.raw_html_target, entry.metadata_target):
+                    downloads.append(bounded(download_html, client, entry))
+                if is_stale(entry.emoji_target, entry.metadata_target):
+                    downloads.append(bounded(download_emoji, client, entry))
+            await asyncio.gather(*downloads)
+
+    def download(targets):
+        asyncio.run(fetch_all())
 
-def task_emoji():
-    def make_download_emoji(entry: Entry):
-        def download_emoji(targets):
-            response = httpx.get(entry.emoji_url)
-            with open(targets[0], "wb") as f:
-                f.write(response.content)
-        return download_emoji
-
-    for entry in book.entries:
-        yield {
-            "name": entry.basename,
-            "file_dep": [entry.metadata_target],
-            "targets": [entry.emoji_target],
-            "actions": [make_download_emoji(entry)],
-        }
+    return {
+        "file_dep": [entry.metadata_target for entry in book.entries],
+        "targets": ([entry.raw_html_target for entry in book.entries]
+                    + [entry.emoji_target for entry in book.entries]),
+        "actions": [download],
+    }
 
 
 def task_readable_html():
     def make_run_readability(entry: Entry):
         def run_readability(targets):
-            with open(entry.raw_html_target) as f:
-                readable = readabilipy.simple_json_from_html_string(f.read(), use_readability=False)
+            # Parse with libxml2 in-process rather than shelling out to Readability.js
+            tree = lxml.html.fromstring(entry.raw_html_target.read_bytes())
+            readable = Document(tree).summary()
             with open(targets[0], "w") as f:
-                f.write(readable["content"])
+                f.write(readable)
         return run_readability
 
     for entry in book.entries:
@@ -176,44 +299,103 @@ def task_readable_html():
         }
 
 
+# Only used for static images, so the encoded result can be kept around
+@functools.lru_cache(maxsize=None)
 def image_to_data_url(path: Path) -> str:
     prefix = f"data:image/{path.suffix[1:]};base64,"
     return prefix + base64.b64encode(path.read_bytes()).decode('utf-8')
 
 
+def is_wide(character: str) -> bool:
+    return unicodedata.east_asian_width(character) in ("W", "F")
+
+
+def wrap_text(text: str, max_width: float, font_size: float) -> t.List[str]:
+    # Greedy wrapping on estimated glyph widths, SVG text doesn't wrap by itself. Lines break at spaces, between
+    # CJK characters (which don't use spaces), and inside words that don't fit on a line of their own.
+    def glyph_width(character: str) -> float:
+        if is_wide(character):
+            return font_size
+        if character.isspace():
+            return font_size * 0.25
+        return font_size * 0.6
+
+    # Words and single wide characters, separated by single spaces
+    tokens = []
+    for character in " ".join(text.split()):
+        if tokens and not character.isspace() and not is_wide(character) \
+                and not tokens[-1][-1].isspace() and not is_wide(tokens[-1][-1]):
+            tokens[-1] += character
+        else:
+            tokens.append(character)
+
+    lines = []
+    line, width = "", 0.0
+    for token in tokens:
+        if token.isspace():
+            if line:
+                line, width = line + token, width + glyph_width(token)
+            continue
+        token_width = sum(map(glyph_width, token))
+        pieces = token if token_width > max_width else [token]
+        for piece in pieces:
+            piece_width = sum(map(glyph_width, piece))
+            if line.strip() and width + piece_width > max_width:
+                lines.append(line.rstrip())
+                line, width = "", 0.0
+            line, width = line + piece, width + piece_width
+    if line.strip():
+        lines.append(line.rstrip())
+    return lines
+
+
+def fit_text(text: str, max_width: float, max_height: float, font_size: float,
+             line_spacing: float) -> t.Tuple[float, t.List[str]]:
+    # Shrink the font until the wrapped text fits in the box
+    lines = wrap_text(text, max_width, font_size)
+    while font_size > 12 and len(lines) * font_size * line_spacing > max_height:
+        font_size *= 0.9
+        lines = wrap_text(text, max_width, font_size)
+    return font_size, lines
+
+
+jinja_env.filters["fit_text"] = fit_text
+
+
 def task_cover():
-    def write_cover_html(targets):
-        template = jinja_env.get_template("cover.jinja")
+    def write_cover_svg(targets):
+        template = jinja_env.get_template("cover.svg.jinja")
         context = {
             # From https://www.transparenttextures.com/
             "background_texture": image_to_data_url(Path("images/paper-fibers.png")),
             "title": book.title,
             "text_direction": "ltr",
         }
-        with open(targets[0], "w") as f:
+        with open(targets[0], "w", encoding="utf-8") as f:
             f.write(template.render(**context))
 
     yield {
-        "name": "html",
-        "file_dep": [book_yaml, "templates/cover.jinja"],
-        "targets": [book.cover_html_target],
-        "actions": [write_cover_html]
+        "name": "svg",
+        "file_dep": [book_yaml, "templates/cover.svg.jinja"],
+        "targets": [book.cover_svg_target],
+        "actions": [write_cover_svg]
     }
 
     def write_cover_image(targets):
-        subprocess.run([
-            "chromium",
-            "--headless",
-            f"--screenshot={targets[0]}",
-            "--window-size=600,800",
-            "--default-background-color=0",
-            "--hide-scrollbars",
-            book.cover_html_target,
-        ])
+        # Imported here as it loads libcairo right away, which only this task needs
+        import cairosvg
+
+        # Rasterize in-process rather than starting up a headless browser
+        cairosvg.svg2png(
+            bytestring=book.cover_svg_target.read_bytes(),
+            output_width=600,
+            output_height=800,
+            write_to=str(targets[0]),
+        )
 
     yield {
         "name": "image",
-        "file_dep": [book.cover_html_target],
+        "file_dep": [book.cover_svg_target],
         "targets": [book.cover_image_target],
         "actions": [write_cover_image]
     }
@@ -223,21 +405,61 @@ class EpubCoverHtml(epub.EpubCoverHtml):
     """
     Custom cover item class that preserves styling.
     """
-    def get_content(self) -> str:
-        self.content = self.book.get_template('cover')
-
-        # Don't let the parent class process content, as it'll strip away the style tag
-        tree = parse_string(self.content)
-        tree_root = tree.getroot()
+    # ebooklib's cover page with placeholders for the image attributes, to be registered as the book's cover template
+    template = epub.COVER_XML.decode("utf-8").replace('<img src="" alt="" />', '<img src="{{IMG_SRC}}" alt="{{IMG_ALT}}" />')
+    # Fail loudly rather than shipping a cover without an image if ebooklib's template ever changes
+    if "{{IMG_SRC}}" not in template or "{{IMG_ALT}}" not in template:
+        raise RuntimeError("Unexpected ebooklib cover template, couldn't insert the cover image placeholders")
 
-        images = tree_root.xpath('//xhtml:img', namespaces={'xhtml': epub.NAMESPACES['XHTML']})
+    def get_content(self) -> bytes:
+        # Don't let the parent class process content, as it'll strip away the style tag.
+        # The page has a known shape, so fill in the placeholders instead of going through an XML parser.
+        self.content = (self.book.get_template('cover')
+                        .replace("{{IMG_SRC}}", escape(self.image_name, {'"': "&quot;"}))
+                        .replace("{{IMG_ALT}}", escape(self.title, {'"': "&quot;"}))
+                        .encode("utf-8"))
 
-        images[0].set('src', self.image_name)
-        images[0].set('alt', self.title)
+        return self.content
 
-        tree_str = etree.tostring(tree, pretty_print=True, encoding='utf-8', xml_declaration=True)
 
-        return tree_str
+class EpubWriter(epub.EpubWriter):
+    """
+    Custom writer that stores images without compressing them again.
+    """
+    def _write_items(self):
+        # Same as the parent class, except that raster images skip compression.
+        # They're already compressed, deflating them only burns CPU for next to no savings.
+        for item in self.book.get_items():
+            if isinstance(item, epub.EpubNcx):
+                name, content = f"{self.book.FOLDER_NAME}/{item.file_name}", self._get_ncx()
+            elif isinstance(item, epub.EpubNav):
+                name, content = f"{self.book.FOLDER_NAME}/{item.file_name}", self._get_nav(item)
+            elif item.manifest:
+                name, content = f"{self.book.FOLDER_NAME}/{item.file_name}", item.get_content()
+            else:
+                name, content = item.file_name, item.get_content()
+
+            is_raster_image = item.media_type.startswith("image/") and item.media_type != "image/svg+xml"
+            self.out.writestr(name, content, compress_type=zipfile.ZIP_STORED if is_raster_image else None)
+
+
+def find_needles(haystack: str, needles: t.Iterable[str]) -> t.Set[str]:
+    # Look for all the needles in a single pass over the haystack, ignoring case.
+    # The needles that were found are returned in lowercase.
+    found = set()
+    automaton = ahocorasick.Automaton()
+    for needle in map(str.lower, needles):
+        if needle:
+            automaton.add_word(needle, needle)
+        else:
+            found.add(needle)
+    if len(automaton) == 0:
+        return found
+
+    automaton.make_automaton()
+    for _, needle in automaton.iter(haystack.lower()):
+        found.add(needle)
+    return found
 
 
 def make_epub(output: str, book: Book):
@@ -250,56 +472,116 @@ def make_epub(output: str, book: Book):
     epub_book.add_author('Various Authors')
 
     epub_book.set_cover("cover.png", book.cover_image_target.read_bytes(), create_page=False)
+    epub_book.set_template("cover", EpubCoverHtml.template)
     cover_page = EpubCoverHtml(image_name="cover.png")
     epub_book.add_item(cover_page)
 
     # create chapters
     chapter_template = jinja_env.get_template("chapter.jinja")
-    chapters = []
-    for i, entry in enumerate(book.entries):
-        chapter_number = i + 1
+
+    def build_chapter(chapter_number: int, entry: Entry) -> t.Tuple[epub.EpubHtml, epub.EpubImage, Path]:
         chapter = epub.EpubHtml(title=entry.chapter_title, file_name=f"chapter_{chapter_number:02}.xhtml", lang="en")
 
         emoji = epub.EpubImage()
         emoji.file_name = entry.emoji_target.name
-        emoji.content = entry.emoji_target.read_bytes()
-        epub_book.add_item(emoji)
 
         # Commented out as it may be better to preserve the original formatting at the expense of improved readability.
         #content = entry.readable_html_target.read_text()
-        raw_html = entry.raw_html_target.read_text()
-        raw_html_lower = raw_html.lower()
-        chapter.content = chapter_template.render(
-            raw_html=raw_html,
-            title=entry.title,
-            url=entry.url,
-            tags=entry.tags,
-            emoji_file_name=emoji.file_name,
-            emoji_name=entry.emoji_name,
-            raw_html_includes_title=entry.title.lower() in raw_html_lower,
-            # Note: There's a chance of false positives if the author managed to weave in the tags in the main text
-            raw_html_includes_tags=all((tag.lower() in raw_html_lower for tag in entry.tags)),
-            raw_html_failed_to_export="cannotExportFile" in raw_html,
-        )
-        epub_book.add_item(chapter)
-        chapters.append(chapter)
-
-    epub_book.toc = chapters
-
-    # add default NCX and Nav file
-    epub_book.add_item(epub.EpubNcx())
-    epub_book.add_item(epub.EpubNav())
-
-    # define CSS style
-    stylesheet = Path("stylesheets/style.css").read_text()
-    style_item = epub.EpubItem(uid="style_nav", file_name="style.css", media_type="text/css", content=stylesheet)
-    epub_book.add_item(style_item)
-
-    # set spine
-    epub_book.spine = [cover_page, 'nav'] + chapters
-
-    # write to the file
-    epub.write_epub(output, epub_book, {})
+        # Read the file once and hash the bytes as they are, they only get decoded when the chapter has to be rendered
+        raw_html_bytes = entry.raw_html_target.read_bytes()
+
+        # Reuse the previous rendering when none of the inputs to the template have changed
+        cache_key = hashlib.sha256(raw_html_bytes)
+        for part in [chapter_cache_version, chapter_template_hash, entry.title, entry.url, "|".join(entry.tags), emoji.file_name, entry.emoji_name]:
+            cache_key.update(b"\0" + part.encode("utf8"))
+        cached_chapter = chapter_cache_dir / f"{cache_key.hexdigest()}.xhtml"
+        if cached_chapter.exists():
+            chapter.content = cached_chapter.read_text(encoding="utf8")
+        else:
+            raw_html = raw_html_bytes.decode("utf-8", errors="replace")
+            found = find_needles(raw_html, [entry.title, *entry.tags])
+            # The marker is plain ASCII, so look for it in the undecoded bytes
+            failed_to_export = b"cannotExportFile" in raw_html_bytes
+            chapter.content = chapter_template.render(
+                raw_html=raw_html,
+                title=entry.title,
+                url=entry.url,
+                tags=entry.tags,
+                emoji_file_name=emoji.file_name,
+                emoji_name=entry.emoji_name,
+                raw_html_includes_title=entry.title.lower() in found,
+                # Note: There's a chance of false positives if the author managed to weave in the tags in the main text
+                raw_html_includes_tags=all((tag.lower() in found for tag in entry.tags)),
+                raw_html_failed_to_export=failed_to_export,
+            )
+            # Write under a temporary name first, an interrupted write must not leave a truncated chapter behind
+            chapter_cache_dir.mkdir(parents=True, exist_ok=True)
+            fd, partial_name = tempfile.mkstemp(dir=chapter_cache_dir, suffix=".tmp")
+            partial_chapter = Path(partial_name)
+            try:
+                with open(fd, "w", encoding="utf8") as f:
+                    f.write(chapter.content)
+                os.replace(partial_chapter, cached_chapter)
+            finally:
+                partial_chapter.unlink(missing_ok=True)
+
+        # Map the file rather than copying it into memory, the zip writer only needs a buffer to read from.
+        # Empty files can't be mapped, but there's nothing to copy for them anyway.
+        # This is done last so that a failure elsewhere in here doesn't leave the mapping open.
+        with open(entry.emoji_target, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                emoji.content = f.read()
+            else:
+                emoji.content = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return chapter, emoji, cached_chapter
+
+    # The entries are independent of each other, so read and render them concurrently
+    futures = []
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for chapter_number, entry in enumerate(book.entries, start=1):
+            futures.append(executor.submit(build_chapter, chapter_number, entry))
+
+    try:
+        results = [future.result() for future in futures]
+
+        # Drop the renderings that no entry refers to anymore
+        cached_chapters = {cached_chapter for _, _, cached_chapter in results}
+        for cached_file in chapter_cache_dir.glob("*"):
+            if cached_file not in cached_chapters:
+                cached_file.unlink()
+
+        # ebooklib isn't thread-safe, so register the items in order afterwards
+        chapters = []
+        for chapter, emoji, _ in results:
+            epub_book.add_item(emoji)
+            epub_book.add_item(chapter)
+            chapters.append(chapter)
+
+        epub_book.toc = chapters
+
+        # add default NCX and Nav file
+        epub_book.add_item(epub.EpubNcx())
+        epub_book.add_item(epub.EpubNav())
+
+        # define CSS style
+        stylesheet = Path("stylesheets/style.css").read_text()
+        style_item = epub.EpubItem(uid="style_nav", file_name="style.css", media_type="text/css", content=stylesheet)
+        epub_book.add_item(style_item)
+
+        # set spine
+        epub_book.spine = [cover_page, 'nav'] + chapters
+
+        # write to the file
+        writer = EpubWriter(output, epub_book, {})
+        writer.process()
+        writer.write()
+    finally:
+        # Unmap the emojis of every chapter that got built, even when another one failed
+        for future in futures:
+            if future.exception() is None:
+                _, emoji, _ = future.result()
+                if isinstance(emoji.content, mmap.mmap):
+                    emoji.content.close()
 
 
 def task_epub():
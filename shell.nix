@@ -20,44 +20,23 @@ let
       maintainers = with maintainers; [];
     };
   };
-  readabilipy = pkgs.python3Packages.buildPythonPackage rec {
-    pname = "readabilipy";
-    version = "0.2.0";
-
-    src = pkgs.python3Packages.fetchPypi {
-      inherit pname version;
-      sha256 = "1rfs1wjrqzqg4gxn28mc8kw8nn3nsx58c23czd120dlzn53z72q9";
-    };
-
-    doCheck = false;
-    propagatedBuildInputs = with pkgs.python3Packages; [
-      beautifulsoup4
-      html5lib
-      lxml
-      regex
-    ];
-
-    meta = with pkgs.lib; {
-      homepage = "https://github.com/alan-turing-institute/ReadabiliPy";
-      description = "A simple HTML content extractor in Python. Can be run as a wrapper for Mozilla's Readability.js package or in pure-python mode.";
-      license = licenses.mit;
-      maintainers = with maintainers; [];
-    };
-  };
 in
 pkgs.mkShell {
   buildInputs = with pkgs; [
-    chromium
     epubcheck
-    #nodejs # Needed for readabilipy
     (python3.withPackages (ps: with ps; [
+      cairosvg
       doit
       ebookLib
+      h2
       httpx
       jinja2
+      orjson
+      pyahocorasick
       pydantic
       pyyaml
-      #readabilipy # Not using readability transformer for now
+      readability-lxml
+      tenacity
     ]))
   ];
   shellHook = ''